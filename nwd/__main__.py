@@ -7,35 +7,58 @@ import sys
 import tempfile
 import time
 
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 
 import psutil
 
+from .cgroup import resolve_cgroup
 from .daemon import spawn_daemon
 from .desktop import DesktopNotifier
 from .email import EmailNotifier, get_email_credentials, prompt_and_save_email_credentials
+from .pool import JobPool, read_commands
+from .rules import load_rules, RoutingNotifier, RuleError, RuleSet, RULES_PATH
+from .run import RunNotifier
 from .tabular import draw_table
 from .term import TerminalNotifier
-from . import notify
+from .watchdog import parse_duration
+from . import notify, outbox, profiling
 
 
-class RunNotifier(notify.Notifier):
-    def __init__(self, run_command, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.run_command = run_command
+def routing_notifier(rules: RuleSet, channels: Dict[str, Callable[..., notify.Notifier]], default: str, *args,
+                     **kwargs) -> RoutingNotifier:
+    return RoutingNotifier(
+        rules, {name: channel(*args, **kwargs) for name, channel in channels.items()}, (default,), *args, **kwargs
+    )
 
-    def notify(self):
-        os.system(self.run_command)
+
+def duration(value: str) -> float:
+    try:
+        return parse_duration(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 def main(argv: Optional[List[str]] = None):  # noqa: C901
+    profile_dir = profiling.profile_dir_from_env()
+    if profile_dir is not None:
+        profiling.enable(profile_dir)
+
     parser = argparse.ArgumentParser(description='Notify When Done (NWD). A tool for posting a desktop notification, '
                                                  'E-mail, or other alert when a process finishes.')
     parser.add_argument('PID', type=int, nargs='?', help='the process ID to monitor')
     parser.add_argument('--name', '-n', type=str, default=None,
                         help='specify the process by its name instead of its PID')
+    parser.add_argument('--cgroup', '-g', type=str, default=None,
+                        help='monitor every process in a cgroup v2, specified either by its path or by the name of '
+                             'its systemd unit, and notify when the cgroup is empty')
     parser.add_argument('--exec', '-e', type=str, default=None,
                         help='executes the given command creates a notification on its completion')
+    parser.add_argument('--exec-many', type=str, default=None, metavar='FILE',
+                        help='executes each line of FILE (or of stdin if FILE is \'-\') as a command, running them in '
+                             'parallel, and creates a single notification once they have all completed')
+    parser.add_argument('--jobs', '-j', type=int, default=None, metavar='N',
+                        help='the maximum number of --exec-many commands to run at once (default: the number of CPU '
+                             'cores)')
     parser.add_argument('--block', '-b', action='store_true', default=False,
                         help='block until the monitored process terminates')
     parser.add_argument('--list', '-l', action='store_true', default=False,
@@ -48,6 +71,24 @@ def main(argv: Optional[List[str]] = None):  # noqa: C901
                         help='sets the notification method, where \'desktop\' (the default) is a desktop notification '
                              'popup, \'email\' sends an e-mail, and \'term\' prints a message to the terminal')
     parser.add_argument('--run', '-r', type=str, default=None, help='run the given command when the process completes')
+    parser.add_argument('--timeout', '-t', type=duration, default=None, metavar='DURATION',
+                        help='also notify if the process is still running after DURATION (e.g., 90s, 10m, or 1h30m); '
+                             'the process is not killed')
+    parser.add_argument('--stall', '-s', type=duration, default=None, metavar='DURATION',
+                        help='also notify if the CPU time and I/O counters of the process (and its children) stop '
+                             'increasing for DURATION')
+    parser.add_argument('--repeat', type=duration, default=None, metavar='DURATION',
+                        help='repeat --timeout and --stall alerts every DURATION for as long as they persist')
+    parser.add_argument('--rules', type=str, default=None, metavar='PATH',
+                        help='route and deduplicate notifications using the rules in this JSON file (default: '
+                             f"{RULES_PATH}, if it exists)")
+    parser.add_argument('--profile', type=str, default=None, metavar='DIR',
+                        help='profile NWD and every monitor daemon it starts, saving CPU and memory allocation '
+                             'profiles to DIR; this can also be enabled by setting the '
+                             f"{profiling.PROFILE_ENV} environment variable to DIR, or to 1 to save them to "
+                             f"{profiling.DEFAULT_PROFILE_DIR}")
+    parser.add_argument('--profile-summary', type=str, default=None, metavar='DIR',
+                        help='summarize the profiles saved in DIR across all NWD processes')
     parser.add_argument('--email-credentials', action='store_true', default=False,
                         help='prompt for the e-mail credentials with which to send alerts and offer to save them to '
                              'the system keychain')
@@ -57,53 +98,97 @@ def main(argv: Optional[List[str]] = None):  # noqa: C901
 
     args = parser.parse_args(argv[1:])
 
-    num_run_args = sum(map(bool, (args.PID, args.name, args.exec)))
+    if args.profile is not None:
+        profiling.enable(args.profile)
+
+    num_run_args = sum(map(bool, (args.PID, args.name, args.cgroup, args.exec, args.exec_many)))
     if num_run_args > 1:
         parser.print_help(sys.stderr)
-        sys.stderr.write('\nYou may only specify at most one of PID, --name, and --exec\n')
+        sys.stderr.write('\nYou may only specify at most one of PID, --name, --cgroup, --exec, and --exec-many\n')
         sys.exit(1)
-    elif num_run_args == 0 and not (args.cleanup or args.list or args.email_credentials):
+    elif num_run_args == 0 and not (args.cleanup or args.list or args.email_credentials or args.profile_summary):
         parser.print_help(sys.stderr)
         sys.exit(1)
 
     if args.delete:
-        if not args.PID and args.name is None:
+        if not args.PID and args.name is None and args.cgroup is None:
             parser.print_help(sys.stderr)
-            sys.stderr.write('\nYou must specify either a PID or a --name when using --delete\n')
+            sys.stderr.write('\nYou must specify either a PID, a --name, or a --cgroup when using --delete\n')
             sys.exit(1)
         elif args.mode is not None:
             parser.print_help(sys.stderr)
             sys.stderr.write('\nA notification --mode may not be specified when using --delete\n')
             sys.exit(1)
-        elif args.exec is not None:
+        elif args.exec is not None or args.exec_many is not None:
             parser.print_help(sys.stderr)
-            sys.stderr.write('\nThe --exec option may not be specified when using --delete\n')
+            sys.stderr.write('\nThe --exec and --exec-many options may not be specified when using --delete\n')
             sys.exit(1)
         elif args.run is not None:
             parser.print_help(sys.stderr)
             sys.stderr.write('\nThe --run option may not be specified when using --delete\n')
             sys.exit(1)
 
+    if args.repeat is not None and args.timeout is None and args.stall is None:
+        parser.print_help(sys.stderr)
+        sys.stderr.write('\nThe --repeat option requires --timeout or --stall\n')
+        sys.exit(1)
+    if args.jobs is not None and args.exec_many is None:
+        parser.print_help(sys.stderr)
+        sys.stderr.write('\nThe --jobs option requires --exec-many\n')
+        sys.exit(1)
+    elif args.jobs is not None and args.jobs < 1:
+        parser.print_help(sys.stderr)
+        sys.stderr.write('\n--jobs must be at least 1\n')
+        sys.exit(1)
+    watchdog_options = {'timeout': args.timeout, 'stall': args.stall, 'repeat': args.repeat}
+
+    rules = None
+    rules_path = args.rules
+    if rules_path is None and os.path.exists(RULES_PATH):
+        rules_path = RULES_PATH
+    if rules_path is not None and not args.delete:
+        try:
+            rules = load_rules(rules_path)
+        except (OSError, RuleError) as e:
+            sys.stderr.write(f"Error loading rules: {e}\n")
+            sys.exit(1)
+
+    if args.run is not None:
+        default_channel = 'run'
+    else:
+        default_channel = args.mode or 'desktop'
+    channels = {default_channel}
+    if rules is not None:
+        if 'run' in rules.channels and args.run is None:
+            sys.stderr.write('Warning: rules that route to the "run" channel are ignored without --run\n')
+        channels |= rules.channels - {'run'}
+
     if args.email_credentials:
         try:
             email_creds = prompt_and_save_email_credentials()
         except KeyboardInterrupt:
             sys.exit(0)
-    elif args.mode == 'email':
+    elif 'email' in channels and num_run_args > 0:
         email_creds = get_email_credentials()
 
     if args.delete:
         for notifier in notify.get_notifiers():
-            if (args.PID and notifier.pid == args.PID) or (args.name is not None and notifier.name == args.name):
-                pid = notifier.pid
+            if (args.PID and notifier.pid == args.PID) or (args.name is not None and notifier.name == args.name) \
+                    or (args.cgroup is not None and args.cgroup in (notifier.cgroup, notifier.name)):
+                description = notifier.description
                 daemonpid = notifier.daemon_pid
                 notifier.terminate()
-                print(f"Deleted NWD daemon PID {daemonpid} monitoring PID {pid}")
+                outbox.discard(daemonpid)
+                print(f"Deleted NWD daemon PID {daemonpid} monitoring {description}")
 
     if args.list:
-        titles = ('PID', 'Name', 'Started', 'Ended', 'Status')
+        titles = ('PID', 'Name', 'Started', 'Ended', 'Status', 'Delivery', 'Resources')
+        deliveries = outbox.delivery_states()
         data = tuple(
-            (str(n.pid), n.name, time.ctime(n.start_time), time.ctime(n.end_time), n.status.name)
+            (
+                '-' if n.pid is None else str(n.pid), n.name, time.ctime(n.start_time), time.ctime(n.end_time),
+                n.status.name, '-' if n.job is not None else deliveries.get(n.daemon_pid, '-'), n.resources or ''
+            )
             for n in notify.get_notifiers()
         )
         if not data:
@@ -111,28 +196,46 @@ def main(argv: Optional[List[str]] = None):  # noqa: C901
         else:
             draw_table(titles, data)
 
+    if args.profile_summary is not None:
+        profiling.summarize(args.profile_summary)
+
     if args.cleanup:
         for notifier, status in notify.cleanup():
             print(f"Cleaned up monitor {notifier.daemon_pid} for process {notifier.pid} ({status.name})")
+        for entry in outbox.cleanup():
+            print(f"Cleaned up {entry['delivery'].lower()} {entry['channel']} notification from monitor "
+                  f"{entry['daemon_pid']}")
+        outbox.resume()
 
     if args.delete:
         return
-    elif args.mode is None and not args.exec and not args.PID and args.name is None and args.run is None:
+    elif args.mode is None and not args.exec and not args.exec_many and not args.PID and args.name is None \
+            and args.cgroup is None and args.run is None:
         return
 
+    # deliver anything a previous monitor left in the outbox, e.g., before a reboot
+    outbox.resume()
+
     stdout_w = None
     stderr_w = None
-    if args.run is not None:
-        Notifier = partial(RunNotifier, args.run)
-    elif args.mode is None or args.mode == 'desktop':
-        Notifier = DesktopNotifier
-    elif args.mode == 'email':
-        if args.exec:
+    channel_notifiers: Dict[str, Callable[..., notify.Notifier]] = {}
+    if 'run' in channels:
+        channel_notifiers['run'] = partial(RunNotifier, args.run)
+    if 'desktop' in channels:
+        channel_notifiers['desktop'] = DesktopNotifier
+    if 'email' in channels:
+        if args.exec and default_channel == 'email':
+            # only capture the output when it is to be e-mailed; rules can still route the notification elsewhere, in
+            # which case the logs are deleted once it is delivered
             stdout_w = tempfile.NamedTemporaryFile(prefix='stdout', suffix='.txt', delete=False)
             stderr_w = tempfile.NamedTemporaryFile(prefix='stderr', suffix='.txt', delete=False)
-        Notifier = partial(EmailNotifier, *email_creds, stdout=stdout_w, stderr=stderr_w)
-    elif args.mode == 'term':
-        Notifier = TerminalNotifier
+        channel_notifiers['email'] = partial(EmailNotifier, *email_creds, stdout=stdout_w, stderr=stderr_w)
+    if 'term' in channels:
+        channel_notifiers['term'] = TerminalNotifier
+    if rules is None:
+        Notifier = channel_notifiers[default_channel]
+    else:
+        Notifier = partial(routing_notifier, rules, channel_notifiers, default_channel)
 
     if args.exec:
         pid = spawn_daemon()
@@ -160,9 +263,39 @@ def main(argv: Optional[List[str]] = None):  # noqa: C901
             sys.stderr.write('\nPlease specify the one you want by its PID\n\n')
             sys.exit(3)
         args.PID = matches[0].pid
+    elif args.exec_many is not None:
+        try:
+            if args.exec_many == '-':
+                commands = read_commands(sys.stdin)
+            else:
+                with open(args.exec_many) as f:
+                    commands = read_commands(f)
+        except OSError as e:
+            sys.stderr.write(f"Error reading commands: {e}\n")
+            sys.exit(2)
+        if not commands:
+            sys.stderr.write('Error: There are no commands to execute\n')
+            sys.exit(2)
+        pool = JobPool(commands, args.jobs)
+        monitor_pid = Notifier(None, **watchdog_options).start(block=args.block, monitor=pool.run)
+        sys.stderr.write(f"Started running {len(commands)} jobs, {pool.slots} at a time, at PID {monitor_pid}\n")
+        return
+    elif args.cgroup is not None:
+        try:
+            cgroup = resolve_cgroup(args.cgroup)
+        except Exception as e:
+            sys.stderr.write(f"Error: {e}\n")
+            sys.exit(2)
+        try:
+            monitor_pid = Notifier(None, cgroup=cgroup, **watchdog_options).start(block=args.block)
+        except Exception as e:
+            sys.stderr.write(f"Error monitoring cgroup {cgroup}: {e}\n")
+            sys.exit(1)
+        sys.stderr.write(f"Started monitoring daemon for cgroup {cgroup} at PID {monitor_pid}\n")
+        return
 
     try:
-        monitor_pid = Notifier(args.PID).start(block=args.block)
+        monitor_pid = Notifier(args.PID, command=args.exec, **watchdog_options).start(block=args.block)
     except Exception as e:
         sys.stderr.write(f"Error monitoring PID {args.PID}: {e}\n")
         if args.exec:
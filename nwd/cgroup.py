@@ -0,0 +1,130 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import subprocess
+import time
+
+from typing import Dict, Optional
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def resolve_cgroup(target: str) -> str:
+    # `target` is either a cgroup v2 directory (absolute, or relative to the cgroup root) or a systemd unit name
+    candidates = [target]
+    if not os.path.isabs(target):
+        candidates.append(os.path.join(CGROUP_ROOT, target))
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(candidate, 'cgroup.events')):
+            return os.path.realpath(candidate)
+    for scope in ((), ('--user',)):
+        try:
+            control_group = subprocess.run(
+                ('systemctl',) + scope + ('show', '--property=ControlGroup', '--value', target),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+            ).stdout.strip()
+        except FileNotFoundError:
+            break
+        if control_group:
+            path = os.path.join(CGROUP_ROOT, control_group.lstrip('/'))
+            if os.path.isfile(os.path.join(path, 'cgroup.events')):
+                return path
+    raise Exception(f"\"{target}\" is neither a cgroup v2 directory nor a running systemd unit")
+
+
+def read_keyed_file(path: str) -> Dict[str, int]:
+    ret = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(' ')
+            try:
+                ret[key] = int(value)
+            except ValueError:
+                pass
+    return ret
+
+
+def is_populated(cgroup: str) -> bool:
+    try:
+        return read_keyed_file(os.path.join(cgroup, 'cgroup.events')).get('populated', 0) != 0
+    except FileNotFoundError:
+        # the cgroup was removed, so it certainly has no more processes
+        return False
+
+
+def resource_usage(cgroup: str) -> Dict[str, Optional[int]]:
+    usage: Dict[str, Optional[int]] = {'cpu_usec': None, 'memory_peak': None}
+    try:
+        usage['cpu_usec'] = read_keyed_file(os.path.join(cgroup, 'cpu.stat')).get('usage_usec')
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(cgroup, 'memory.peak')) as f:
+            usage['memory_peak'] = int(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    return usage
+
+
+class CgroupWatch:
+    def __init__(self, cgroup: str):
+        self.cgroup = cgroup
+        self.usage: Dict[str, Optional[int]] = resource_usage(cgroup)
+        self._fd: Optional[int] = None
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, os.path.join(cgroup, 'cgroup.events').encode('utf8'),
+                                  IN_MODIFY | IN_DELETE_SELF) < 0:
+            os.close(fd)
+            return
+        self._fd = fd
+
+    def _update_usage(self):
+        usage = resource_usage(self.cgroup)
+        # keep the last values we saw if the cgroup has since been removed
+        self.usage.update({key: value for key, value in usage.items() if value is not None})
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # Blocks until the cgroup is empty or `timeout` seconds elapse, returning whether the cgroup is empty
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            self._update_usage()
+            if not is_populated(self.cgroup):
+                return True
+            remaining = None if timeout is None else max(deadline - time.monotonic(), 0.0)
+            if remaining is not None and remaining <= 0.0:
+                return False
+            if self._fd is None:
+                # inotify is unavailable, so fall back to polling
+                time.sleep(POLL_INTERVAL if remaining is None else min(remaining, POLL_INTERVAL))
+                continue
+            readable, _, _ = select.select((self._fd,), (), (), remaining)
+            if not readable:
+                continue
+            data = os.read(self._fd, 4096)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size + name_len
+                if mask & (IN_DELETE_SELF | IN_IGNORED):
+                    return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -10,11 +10,17 @@ def spawn_daemon():
         pid = os.fork()
         if pid > 0:
             # we are the parent process
-            return int(os.fdopen(r).readline().strip())
+            os.close(w)
+            with os.fdopen(r) as f:
+                child_pid = int(f.readline().strip())
+            # reap the intermediate child so that long-lived callers do not accumulate zombies
+            os.waitpid(pid, 0)
+            return child_pid
     except OSError as e:
         sys.stderr.write(f"fork #1 failed: {e.errno} ({e.strerror})\n")
         sys.exit(os.EX_OSERR)
 
+    os.close(r)
     os.setsid()
 
     # do second fork
@@ -23,8 +29,10 @@ def spawn_daemon():
         if pid > 0:
             # we are the parent process; let our parent know about our child's PID:
             os.write(w, f"{pid}\n".encode('utf8'))
-            sys.exit(os.EX_OK)
+            # exit immediately, without running this process's atexit handlers (e.g., saving a profile)
+            os._exit(os.EX_OK)
     except OSError as e:
         sys.stderr.write(f"fork #2 failed: {e.errno} ({e.strerror})")
         sys.exit(os.EX_OSERR)
+    os.close(w)
     return 0
@@ -1,5 +1,4 @@
 import sys
-import time
 
 from .notify import Notifier
 
@@ -12,8 +11,14 @@ else:
 
 
 class DesktopNotifier(Notifier):
+    channel = 'desktop'
+
     def notify(self):
-        message = f"Process {self.pid} finished at {time.ctime(self.end_time)}"
-        if self.exitcode is not None:
-            message = f"{message} with exit code {self.exitcode}."
-        notify('nwd', f"{self.name} finished!", message)
+        message = f"{self.summary()}."
+        resources = self.resources
+        if resources is not None:
+            message = f"{message} Used {resources}."
+        job_report = self.job_report()
+        if job_report:
+            message = f"{message}\n{job_report}"
+        notify('nwd', self.headline, message)
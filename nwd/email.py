@@ -5,15 +5,16 @@ import getpass
 import os
 import socket
 import sys
-import time
 
-from typing import Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import keyring
 
 from .notify import Notifier
 
 KEYRING_NAME = 'NotifyWhenDone'
+# seconds to wait on the SMTP server before giving up (and retrying later)
+SMTP_TIMEOUT = 60.0
 
 
 def prompt(
@@ -198,6 +199,8 @@ def get_recipient(default_recipient: Optional[str] = None) -> str:
 
 
 class EmailNotifier(Notifier):
+    channel = 'email'
+
     def __init__(
             self,
             sender_name: str = None,
@@ -206,47 +209,140 @@ class EmailNotifier(Notifier):
             smtp_server: str = None,
             smtp_port: int = None,
             *args,
+            to_email: Optional[str] = None,
             **kwargs
     ):
         super().__init__(*args, **kwargs)
         self.sender_name, self.sender_email, self.sender_password, self.smtp_server, self.smtp_port = \
             get_email_credentials(sender_name, sender_email, sender_password, smtp_server, smtp_port)
-        self.to_email = get_recipient(self.sender_email)
-
-    def notify(self):
-        # Need to import smtplib here, otherwise it will segfault if we import it before the fork()
-        import smtplib
+        if to_email is None:
+            to_email = get_recipient(self.sender_email)
+        self.to_email = to_email
+
+    def spec(self) -> Dict[str, Any]:
+        # the password is deliberately left out so that it is never written to disk
+        return {
+            'sender_name': self.sender_name,
+            'sender_email': self.sender_email,
+            'smtp_server': self.smtp_server,
+            'smtp_port': self.smtp_port,
+            'to_email': self.to_email,
+            'stdout': _log_path(self.stdout),
+            'stderr': _log_path(self.stderr)
+        }
+
+    @classmethod
+    def from_spec(cls, pid: Optional[int], spec: Dict[str, Any]) -> 'EmailNotifier':
+        sender_name, sender_email, sender_password, smtp_server, smtp_port = get_keychain_credentials()
+        if sender_password is None or sender_email != spec['sender_email']:
+            raise Exception(f"The password for {spec['sender_email']} is not saved in the system keychain; "
+                            'run `nwd --email-credentials` to save it')
+        return cls(
+            spec['sender_name'], spec['sender_email'], sender_password, spec['smtp_server'], spec['smtp_port'], pid,
+            to_email=spec['to_email'], stdout=spec['stdout'], stderr=spec['stderr']
+        )
+
+    def _message(self) -> MIMEMultipart:
         msg = MIMEMultipart()
-        msg['Subject'] = f"NWD: {self.name} finished!"
+        msg['Subject'] = f"NWD: {self.headline}"
         msg['From'] = f"{self.sender_name} <{self.sender_email}>"
         msg['To'] = self.to_email
-        message = f"Process {self.pid} on {socket.gethostname()} finished at {time.ctime(self.end_time)}"
-        if self.exitcode is not None:
-            message = f"{message} with exit code {self.exitcode}"
-        message = f"{message}.\n\n`{' '.join(self.commandline)}`"
-        if self.stdout or self.stderr:
+        message = f"{self.summary()}.\n\nHost: {socket.gethostname()}"
+        resources = self.resources
+        if resources is not None:
+            message = f"{message}\n\nResources used: {resources}."
+        if self.commandline:
+            message = f"{message}\n\n`{' '.join(self.commandline)}`"
+        job_report = self.job_report()
+        if job_report:
+            message = f"{message}\n\n{job_report}"
+        logs = self._logs()
+        if logs:
             message = f"{message}\n\nProgram output logs are attached."
         message = f"{message}\n\nAutomatically sent by NWD!\nhttps://github.com/esultanik/nwd\n"
         msg.attach(MIMEText(message))
 
-        for logstream, name in ((self.stdout, 'stdout.txt'), (self.stderr, 'stderr.txt')):
-            if logstream is not None:
-                with open(logstream.name, "rb") as f:
-                    part = MIMEApplication(
-                        f.read(),
-                        Name=name
-                    )
-                try:
-                    os.unlink(logstream.name)
-                except Exception as e:
-                    print(e)
-                part['Content-Disposition'] = f"attachment; filename=\"{name}\""
-                msg.attach(part)
-
-        server = smtplib.SMTP(f"{self.smtp_server}:{self.smtp_port}")
+        for path, name in logs:
+            with open(path, "rb") as f:
+                part = MIMEApplication(
+                    f.read(),
+                    Name=name
+                )
+            part['Content-Disposition'] = f"attachment; filename=\"{name}\""
+            msg.attach(part)
+        return msg
+
+    def _logs(self) -> List[Tuple[str, str]]:
+        # the output logs are only complete once the process has finished, so they are not attached to alerts
+        if self.alert is not None:
+            return []
+        return [
+            (_log_path(logstream), name) for logstream, name in ((self.stdout, 'stdout.txt'), (self.stderr, 'stderr.txt'))
+            if logstream is not None and os.path.exists(_log_path(logstream))
+        ]
+
+    def _delete_logs(self):
+        # only delete the logs once they have been sent, so that a failed delivery can be retried with them
+        for path, _ in self._logs():
+            try:
+                os.unlink(path)
+            except Exception as e:
+                print(e)
+
+    def _connect(self):
+        # Need to import smtplib here, otherwise it will segfault if we import it before the fork()
+        import smtplib
+        server = smtplib.SMTP(f"{self.smtp_server}:{self.smtp_port}", timeout=SMTP_TIMEOUT)
         server.starttls()
         server.login(self.sender_email, self.sender_password)
+        return server
+
+    def _send(self, server):
         server.sendmail(self.sender_email,
                         [self.to_email],
-                        msg.as_string())
+                        self._message().as_string())
+        self._delete_logs()
+
+    def notify(self):
+        server = self._connect()
+        self._send(server)
         server.quit()
+
+    @classmethod
+    def notify_all(cls, notifiers: List[Notifier]) -> List[Optional[Exception]]:
+        # send every message that shares an SMTP account over a single connection
+        errors: List[Optional[Exception]] = [None] * len(notifiers)
+        accounts: Dict[Tuple[str, int, str], List[int]] = {}
+        for i, notifier in enumerate(notifiers):
+            accounts.setdefault((notifier.smtp_server, notifier.smtp_port, notifier.sender_email), []).append(i)
+        for indices in accounts.values():
+            account_errors = cls._notify_account([notifiers[i] for i in indices])
+            for i, error in zip(indices, account_errors):
+                errors[i] = error
+        return errors
+
+    @staticmethod
+    def _notify_account(notifiers: List['EmailNotifier']) -> List[Optional[Exception]]:
+        try:
+            server = notifiers[0]._connect()
+        except Exception as e:
+            return [e] * len(notifiers)
+        errors: List[Optional[Exception]] = []
+        for notifier in notifiers:
+            try:
+                notifier._send(server)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        try:
+            server.quit()
+        except Exception:
+            pass
+        return errors
+
+
+def _log_path(logstream) -> Optional[str]:
+    # logs are either open files (when first monitored) or paths (when recreated from the outbox)
+    if logstream is None or isinstance(logstream, str):
+        return logstream
+    return logstream.name
@@ -1,20 +1,35 @@
 from enum import Enum
+from functools import partial
 import json
 import os
 from pathlib import Path
 import sys
 import time
 
-from typing import Dict, Iterable, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 import psutil
 
+from .cgroup import CgroupWatch
 from .daemon import spawn_daemon
+from .watchdog import Alert, ProcSampler, TimerWheel, Watchdog
 
 PID_DIR = os.path.join(str(Path.home()), '.nwd')
 os.makedirs(PID_DIR, exist_ok=True)
 
 
+def format_bytes(num_bytes: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return f"{num_bytes}{unit}"
+    return f"{num_bytes:.1f}{unit}"
+
+
 class Status(Enum):
     NOT_STARTED = 0
     MONITORING = 1
@@ -32,13 +47,41 @@ def cleanup():
 
 
 class Notifier:
-    def __init__(self, pid: int, daemon_pid: Optional[int] = None, stdout=None, stderr=None):
+    # the name of the notification channel that this class implements, used to recreate it from the outbox
+    channel: Optional[str] = None
+
+    def __init__(
+            self,
+            pid: Optional[int],
+            daemon_pid: Optional[int] = None,
+            stdout=None,
+            stderr=None,
+            cgroup: Optional[str] = None,
+            timeout: Optional[float] = None,
+            stall: Optional[float] = None,
+            repeat: Optional[float] = None,
+            job: Optional[int] = None,
+            command: Optional[str] = None
+    ):
         self.pidfile = None
         self.pid = pid
+        # the index of this job within a batch run by the daemon, if this is one of many jobs it is running
+        self.job = job
+        # the command that was run to start the process, if NWD ran it
+        self.command = command
+        self._cgroup = cgroup
+        self.timeout = timeout
+        self.stall = stall
+        self.repeat = repeat
+        self.alert: Optional[Alert] = None
+        self.alert_detail: Optional[str] = None
+        # a saved copy of the status record to notify about instead of the live one
+        self.snapshot: Optional[Dict[str, Any]] = None
         self._daemon_pid = None
         self.daemon_pid = daemon_pid
         self.stdout = stdout
         self.stderr = stderr
+        self._outbox: Dict[str, Notifier] = {}
 
     @property
     def daemon_pid(self) -> int:
@@ -51,19 +94,30 @@ class Notifier:
                 return
             raise Exception(f"Cannot set the daemon PID to {pid} because it is already set to {self._daemon_pid}")
         self._daemon_pid = pid
-        if pid is not None:
+        if pid is not None and self.job is not None:
+            self.pidfile = os.path.join(PID_DIR, f"{pid}.{self.job}")
+        elif pid is not None:
             self.pidfile = os.path.join(PID_DIR, str(pid))
 
     def _raw_status(self) -> Dict[str, Union[int, str, List[str], Optional[float]]]:
+        if self.snapshot is not None:
+            return self.snapshot
         if self.pidfile is None or not os.path.exists(self.pidfile):
+            if self._cgroup is not None:
+                name = os.path.basename(self._cgroup)
+            else:
+                name = f"Process {self.pid}"
             return {
                 'pid': self.pid,
-                'name': f"Process {self.pid}",
+                'name': name,
                 'commandline': [],
                 'exitcode': None,
                 'started': None,
                 'finished': None,
-                'status': Status.NOT_STARTED.name
+                'status': Status.NOT_STARTED.name,
+                'cgroup': self._cgroup,
+                'cpu_usec': None,
+                'memory_peak': None
             }
         with open(self.pidfile) as f:
             return json.load(f)
@@ -97,6 +151,76 @@ class Notifier:
     def commandline(self) -> List[str]:
         return self._raw_status()['commandline']
 
+    @property
+    def cgroup(self) -> Optional[str]:
+        return self._raw_status().get('cgroup')
+
+    @property
+    def cpu_time(self) -> Optional[float]:
+        cpu_usec = self._raw_status().get('cpu_usec')
+        if cpu_usec is None:
+            return None
+        return cpu_usec / 1000000.0
+
+    @property
+    def memory_peak(self) -> Optional[int]:
+        return self._raw_status().get('memory_peak')
+
+    @property
+    def jobs(self) -> List[Dict[str, Any]]:
+        return self._raw_status().get('jobs', [])
+
+    def job_report(self) -> str:
+        # one line per job in a batch, with its exit code and runtime
+        lines = []
+        for index, job in enumerate(self.jobs, start=1):
+            if job['exitcode'] is None:
+                result = 'did not run'
+            else:
+                result = f"exit code {job['exitcode']}"
+            if job['started'] is not None and job['finished'] is not None:
+                result = f"{result} after {job['finished'] - job['started']:.1f}s"
+            lines.append(f"{index}. `{job['command']}`: {result}")
+        return '\n'.join(lines)
+
+    @property
+    def description(self) -> str:
+        jobs = self.jobs
+        if jobs:
+            failures = sum(1 for job in jobs if job['exitcode'] not in (None, 0))
+            return f"Batch of {len(jobs)} jobs ({failures} failed)"
+        cgroup = self.cgroup
+        if cgroup is not None:
+            return f"cgroup {cgroup}"
+        return f"Process {self.pid}"
+
+    @property
+    def headline(self) -> str:
+        if self.alert is not None:
+            return f"{self.name} {self.alert.value}!"
+        return f"{self.name} finished!"
+
+    def summary(self) -> str:
+        if self.alert is not None:
+            return f"{self.description} {self.alert_detail}"
+        message = f"{self.description} finished at {time.ctime(self.end_time)}"
+        if self.exitcode is not None:
+            message = f"{message} with exit code {self.exitcode}"
+        return message
+
+    @property
+    def resources(self) -> Optional[str]:
+        cpu_time = self.cpu_time
+        memory_peak = self.memory_peak
+        usage = []
+        if cpu_time is not None:
+            usage.append(f"{cpu_time:.1f}s CPU")
+        if memory_peak is not None:
+            usage.append(f"{format_bytes(memory_peak)} peak memory")
+        if not usage:
+            return None
+        return ', '.join(usage)
+
     @property
     def exitcode(self) -> Optional[int]:
         return self._raw_status()['exitcode']
@@ -108,6 +232,30 @@ class Notifier:
     def notify(self):
         raise NotImplementedError('Subclasses of Notifier must implement the notify() function')
 
+    @classmethod
+    def notify_all(cls, notifiers: List['Notifier']) -> List[Optional[Exception]]:
+        # notifies a batch of notifiers of this class, returning the exception (if any) raised by each
+        errors: List[Optional[Exception]] = []
+        for notifier in notifiers:
+            try:
+                notifier.notify()
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    def spec(self) -> Dict[str, Any]:
+        # the JSON-serializable arguments needed to recreate this notifier with from_spec()
+        return {}
+
+    @classmethod
+    def from_spec(cls, pid: Optional[int], spec: Dict[str, Any]) -> 'Notifier':
+        return cls(pid, **spec)
+
+    def deliveries(self) -> List['Notifier']:
+        # the channel notifiers that should be notified about the current status
+        return [self]
+
     @property
     def start_time(self) -> float:
         return self._raw_status()['started']
@@ -122,7 +270,9 @@ class Notifier:
             psutil.wait_procs([psutil.Process(self.daemon_pid)])
         os.unlink(self.pidfile)
 
-    def start(self, block=False) -> int:
+    def start(self, block=False, monitor: Optional[Callable[['Notifier'], None]] = None) -> int:
+        # `monitor`, if provided, replaces monitoring the PID or cgroup: it is called in the daemon with this notifier
+        # and should record the results in its status before it returns
         if self.daemon_pid is not None:
             return self.daemon_pid
         if not block:
@@ -135,44 +285,108 @@ class Notifier:
         # We are now executing in the daemon process
         self.daemon_pid = os.getpid()
         self.status = Status.MONITORING
-        # Maybe the process is already finished?
-        process = psutil.Process(self.pid)
-        if process.is_running():
+        if monitor is not None:
+            monitor(self)
+        elif self._cgroup is not None:
             self._save_status(
-                name=process.name(),
-                commandline=process.cmdline(),
-                started=process.create_time()
+                name=os.path.basename(self._cgroup),
+                started=time.time()
             )
-            exitcode = process.wait()
-            if exitcode is not None:
+            watch = CgroupWatch(self._cgroup)
+            try:
+                self._watch(watch.wait)
+            finally:
+                watch.close()
+            self._save_status(
+                finished=time.time(),
+                **watch.usage
+            )
+        else:
+            # Maybe the process is already finished?
+            process = psutil.Process(self.pid)
+            if process.is_running():
                 self._save_status(
-                    exitcode=process.wait(),
-                    finished=time.time()
+                    name=process.name(),
+                    commandline=process.cmdline(),
+                    command=self.command if self.command is not None else ' '.join(process.cmdline()),
+                    started=process.create_time()
                 )
+                self._watch(partial(_process_exited, process))
+                exitcode = process.wait()
+                if exitcode is not None:
+                    self._save_status(
+                        exitcode=exitcode,
+                        finished=time.time()
+                    )
+                else:
+                    self._save_status(
+                        finished=time.time()
+                    )
             else:
                 self._save_status(
                     finished=time.time()
                 )
-        else:
-            self._save_status(
-                finished=time.time()
-            )
         self.status = Status.NOTIFYING
-        self.notify()
-        self.status = Status.NOTIFIED
+        self._deliver(wait=True)
         sys.exit(os.EX_OK)
 
+    def _deliver(self, wait: bool):
+        # Notifications are written to the durable outbox before they are sent, so a slow or broken channel can
+        # neither kill this daemon nor lose them
+        from . import outbox  # imported here because the outbox depends on this module
+        for notifier in self.deliveries():
+            self._outbox[outbox.enqueue(self, notifier)] = notifier
+        if wait:
+            self.status = Status.NOTIFIED
+            outbox.drain(self._outbox)
+        else:
+            # Alerts are sent by a separate worker so that a slow channel cannot hold up monitoring. Anything that the
+            # worker cannot send, e.g., for lack of credentials, is sent from here once monitoring finishes.
+            outbox.resume()
+
+    def _watch(self, wait: Callable[[Optional[float]], bool]):
+        # `wait(timeout)` blocks for at most `timeout` seconds, returning whether the monitored process finished
+        if self.timeout is None and self.stall is None:
+            wait(None)
+            return
+        wheel = TimerWheel()
+        watchdog = Watchdog(self._alert, wheel, ProcSampler(wheel), self.start_time, timeout=self.timeout,
+                            stall=self.stall, repeat=self.repeat, pid=self.pid, cgroup=self._cgroup)
+        while not wait(wheel.next_timeout()):
+            wheel.advance()
+        watchdog.cancel()
+
+    def _alert(self, alert: Alert, detail: str):
+        self.alert = alert
+        self.alert_detail = detail
+        try:
+            self._deliver(wait=False)
+        finally:
+            self.alert = None
+            self.alert_detail = None
+
+
+def _process_exited(process: psutil.Process, timeout: Optional[float]) -> bool:
+    try:
+        process.wait(timeout)
+    except psutil.TimeoutExpired:
+        return False
+    return True
+
 
 def get_notifiers(for_pid: Optional[int] = None) -> Iterable[Notifier]:
-    for pid in os.listdir(PID_DIR):
-        path = os.path.join(PID_DIR, pid)
+    for filename in os.listdir(PID_DIR):
+        path = os.path.join(PID_DIR, filename)
         if not os.path.isfile(path):
             continue
+        # jobs in a batch are saved as "daemon_pid.job"
+        pid, _, job = filename.partition('.')
         try:
             pid = int(pid)
+            job = int(job) if job else None
         except ValueError:
             continue
         with open(path) as f:
             proc_pid: int = json.load(f)['pid']
         if for_pid is None or for_pid == proc_pid:
-            yield Notifier(pid=proc_pid, daemon_pid=pid)
+            yield Notifier(pid=proc_pid, daemon_pid=pid, job=job)
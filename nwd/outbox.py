@@ -0,0 +1,251 @@
+import copy
+from enum import Enum
+import fcntl
+import importlib
+import json
+import os
+import sys
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .daemon import spawn_daemon
+from .notify import Notifier, PID_DIR
+from .watchdog import Alert
+
+OUTBOX_DIR = os.path.join(PID_DIR, 'outbox')
+LOCK_PATH = os.path.join(PID_DIR, 'outbox.lock')
+WORKER_PATH = os.path.join(PID_DIR, 'outbox.worker')
+os.makedirs(OUTBOX_DIR, exist_ok=True)
+
+RETRY_DELAY = 10.0
+MAX_RETRY_DELAY = 60.0 * 60.0
+MAX_ATTEMPTS = 10
+POLL_INTERVAL = 1.0
+
+CHANNEL_CLASSES = {
+    'desktop': ('nwd.desktop', 'DesktopNotifier'),
+    'email': ('nwd.email', 'EmailNotifier'),
+    'term': ('nwd.term', 'TerminalNotifier'),
+    'run': ('nwd.run', 'RunNotifier')
+}
+
+Entry = Dict[str, Any]
+
+
+class Delivery(Enum):
+    PENDING = 0
+    RETRYING = 1
+    DELIVERED = 2
+    FAILED = 3
+
+
+def _write(path: str, entry: Entry):
+    # write atomically so that a crash can never leave a truncated entry behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+def entries() -> Iterable[Tuple[str, Entry]]:
+    for filename in sorted(os.listdir(OUTBOX_DIR)):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(OUTBOX_DIR, filename)
+        try:
+            with open(path) as f:
+                yield path, json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def enqueue(source: Notifier, channel: Notifier) -> str:
+    # persists a notification of `source`'s current status to be sent through `channel`, returning its outbox path
+    now = time.time()
+    path = os.path.join(OUTBOX_DIR, f"{int(now * 1000000)}-{source.daemon_pid}-{channel.channel}.json")
+    _write(path, {
+        'daemon_pid': source.daemon_pid,
+        'channel': channel.channel,
+        'spec': channel.spec(),
+        'record': source._raw_status(),
+        'alert': None if source.alert is None else source.alert.name,
+        'alert_detail': source.alert_detail,
+        'delivery': Delivery.PENDING.name,
+        'attempts': 0,
+        'next_attempt': now,
+        'error': None
+    })
+    return path
+
+
+def _channel_notifier(entry: Entry, local: Dict[str, Notifier], path: str) -> Notifier:
+    if path in local:
+        # a copy, so that the snapshot below does not affect the original notifier
+        notifier = copy.copy(local[path])
+    else:
+        if entry['channel'] not in CHANNEL_CLASSES:
+            raise Exception(f"Unknown notification channel \"{entry['channel']}\"")
+        module_name, class_name = CHANNEL_CLASSES[entry['channel']]
+        cls = getattr(importlib.import_module(module_name), class_name)
+        notifier = cls.from_spec(entry['record']['pid'], entry['spec'])
+    notifier.snapshot = entry['record']
+    notifier.alert = None if entry['alert'] is None else Alert[entry['alert']]
+    notifier.alert_detail = entry['alert_detail']
+    return notifier
+
+
+def _deliver_due(local: Dict[str, Notifier], retry_local: bool = False) -> Optional[float]:
+    # Attempts every entry that is due, one batch per channel, and returns when the next retry is due (if ever). If
+    # `retry_local` is True, the entries in `local` are attempted now even if they are backing off, e.g., because
+    # another process could not send them without the credentials that only `local` holds.
+    now = time.time()
+    next_attempt = None
+    batches: Dict[str, List[Tuple[str, Entry, Notifier]]] = {}
+    for path, entry in entries():
+        if entry['delivery'] not in (Delivery.PENDING.name, Delivery.RETRYING.name):
+            continue
+        elif entry['next_attempt'] > now and not (retry_local and path in local):
+            if next_attempt is None or entry['next_attempt'] < next_attempt:
+                next_attempt = entry['next_attempt']
+            continue
+        try:
+            notifier = _channel_notifier(entry, local, path)
+        except Exception as e:
+            next_attempt = _record_failure(path, entry, e, next_attempt)
+            continue
+        batches.setdefault(entry['channel'], []).append((path, entry, notifier))
+    for batch in batches.values():
+        errors = type(batch[0][2]).notify_all([notifier for _, _, notifier in batch])
+        for (path, entry, _), error in zip(batch, errors):
+            if error is None:
+                entry.update(delivery=Delivery.DELIVERED.name, attempts=entry['attempts'] + 1, error=None)
+                _write(path, entry)
+                local.pop(path, None)
+            else:
+                next_attempt = _record_failure(path, entry, error, next_attempt)
+    return next_attempt
+
+
+def _record_failure(path: str, entry: Entry, error: Exception, next_attempt: Optional[float]) -> Optional[float]:
+    # schedules a retry with exponential backoff, returning the earlier of it and `next_attempt`
+    attempts = entry['attempts'] + 1
+    if attempts >= MAX_ATTEMPTS:
+        delivery = Delivery.FAILED
+    else:
+        delivery = Delivery.RETRYING
+    entry.update(
+        delivery=delivery.name,
+        attempts=attempts,
+        next_attempt=time.time() + min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY),
+        error=str(error) or type(error).__name__
+    )
+    _write(path, entry)
+    if delivery == Delivery.FAILED or (next_attempt is not None and next_attempt < entry['next_attempt']):
+        return next_attempt
+    return entry['next_attempt']
+
+
+def _deliver_locked(local: Dict[str, Notifier], retry_local: bool = False) -> Optional[float]:
+    # the lock is only held while delivering, never while waiting to retry, so other monitors are not held up
+    with open(LOCK_PATH, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _deliver_due(local, retry_local)
+
+
+def _outbox_version() -> int:
+    # the outbox directory changes whenever an entry is enqueued or updated
+    return os.stat(OUTBOX_DIR).st_mtime_ns
+
+
+def _sleep_until(when: float):
+    # sleeps until `when`, waking early if anything is enqueued in the meantime
+    version = _outbox_version()
+    while time.time() < when:
+        time.sleep(min(when - time.time(), POLL_INTERVAL))
+        if _outbox_version() != version:
+            return
+
+
+def drain(local: Optional[Dict[str, Notifier]] = None):
+    # Delivers the outbox, retrying with backoff. `local` maps outbox paths to the in-memory notifiers that enqueued
+    # them, which may hold credentials that are not saved to disk; those entries are attempted right away, even if
+    # another process already failed to send them. If `local` is given, this only waits until those entries are
+    # delivered (or have failed), and leaves the rest of the outbox to a worker; otherwise, it waits for everything.
+    if local is None:
+        local = {}
+    paths = list(local) or None
+    next_attempt = _deliver_locked(local, retry_local=True)
+    while pending(paths):
+        if next_attempt is not None:
+            _sleep_until(next_attempt)
+        next_attempt = _deliver_locked(local)
+    if paths is not None:
+        resume()
+
+
+def pending(paths: Optional[Iterable[str]] = None) -> bool:
+    # whether anything in the outbox (or, if given, any of the entries at `paths`) is still to be delivered
+    if paths is None:
+        selected: Iterable[Tuple[str, Entry]] = entries()
+    else:
+        selected = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    selected.append((path, json.load(f)))
+            except (OSError, ValueError):
+                continue
+    return any(entry['delivery'] in (Delivery.PENDING.name, Delivery.RETRYING.name) for _, entry in selected)
+
+
+def resume():
+    # Spawns a worker to deliver anything in the outbox, e.g., alerts, notifications that their monitors could not
+    # send, or notifications left by a worker that did not survive a reboot. At most one worker runs at a time: it
+    # holds the worker lock, which is taken here and inherited across the fork, until it exits.
+    if not pending():
+        return
+    worker = open(WORKER_PATH, 'a')
+    try:
+        try:
+            fcntl.flock(worker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # another worker is already delivering the outbox
+            return
+        if spawn_daemon() == 0:
+            drain()
+            sys.exit(os.EX_OK)
+    finally:
+        worker.close()
+
+
+def delivery_states() -> Dict[int, str]:
+    # summarizes the delivery state of each monitor's notifications, keyed by the monitor's daemon PID
+    severity = (Delivery.DELIVERED.name, Delivery.PENDING.name, Delivery.RETRYING.name, Delivery.FAILED.name)
+    worst: Dict[int, Entry] = {}
+    for _, entry in entries():
+        previous = worst.get(entry['daemon_pid'])
+        if previous is None or severity.index(entry['delivery']) > severity.index(previous['delivery']):
+            worst[entry['daemon_pid']] = entry
+    states = {}
+    for daemon_pid, entry in worst.items():
+        state = entry['delivery']
+        if entry['delivery'] == Delivery.RETRYING.name:
+            state = f"{state} ({entry['attempts']}x: {entry['error']})"
+        elif entry['delivery'] == Delivery.FAILED.name:
+            state = f"{state} ({entry['error']})"
+        states[daemon_pid] = state
+    return states
+
+
+def discard(daemon_pid: int):
+    for path, entry in entries():
+        if entry['daemon_pid'] == daemon_pid:
+            os.unlink(path)
+
+
+def cleanup() -> Iterable[Entry]:
+    for path, entry in entries():
+        if entry['delivery'] in (Delivery.DELIVERED.name, Delivery.FAILED.name):
+            os.unlink(path)
+            yield entry
@@ -0,0 +1,191 @@
+import os
+import select
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, TextIO
+
+from .notify import Notifier, Status
+from .watchdog import Alert, ProcSampler, TimerWheel, Watchdog
+
+
+def read_commands(stream: TextIO) -> List[str]:
+    # one command per line; blank lines and comments are ignored
+    return [line.strip() for line in stream if line.strip() and not line.strip().startswith('#')]
+
+
+def _exitcode(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Job:
+    def __init__(self, index: int, command: str, record: Notifier):
+        self.index = index
+        self.command = command
+        self.record = record
+        self.process: Optional[subprocess.Popen] = None
+        self.watchdog: Optional[Watchdog] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.exitcode: Optional[int] = None
+        self.cpu_usec: Optional[int] = None
+
+
+class JobPool:
+    # Runs commands with at most `slots` of them at once, recording each as its own job in the registry. The pool
+    # sleeps until either a job exits (SIGCHLD) or a watchdog timer is due, so an idle pool uses no CPU.
+    def __init__(self, commands: Iterable[str], slots: Optional[int] = None):
+        self.commands = list(commands)
+        if slots is None:
+            slots = os.cpu_count() or 1
+        self.slots = max(slots, 1)
+
+    def run(self, notifier: Notifier):
+        notifier.pid = os.getpid()
+        notifier._save_status(
+            pid=notifier.pid,
+            name=f"{len(self.commands)} jobs",
+            commandline=[],
+            started=time.time()
+        )
+        jobs = [
+            Job(index, command, Notifier(None, daemon_pid=notifier.daemon_pid, job=index))
+            for index, command in enumerate(self.commands, start=1)
+        ]
+        for job in jobs:
+            job.record.status = Status.NOT_STARTED
+            job.record._save_status(name=_job_name(job.command), commandline=_argv(job.command) or [job.command],
+                                    command=job.command)
+        notifier._save_status(jobs=_job_summaries(jobs))
+
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_w, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_w)
+        try:
+            self._run_jobs(jobs, notifier, wakeup_r)
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+
+        failures = [job.exitcode for job in jobs if job.exitcode != 0]
+        notifier._save_status(
+            finished=time.time(),
+            exitcode=failures[0] if failures else 0,
+            cpu_usec=sum(job.cpu_usec or 0 for job in jobs),
+            jobs=_job_summaries(jobs)
+        )
+
+    def _run_jobs(self, jobs: List[Job], notifier: Notifier, wakeup_r: int):
+        # sleeps until either a job exits, which writes to `wakeup_r`, or a watchdog timer is due
+        queue = list(reversed(jobs))
+        wheel = TimerWheel()
+        sampler = ProcSampler(wheel)
+        running: Dict[int, Job] = {}
+        while queue or running:
+            while queue and len(running) < self.slots:
+                job = queue.pop()
+                if self._start(job, notifier, wheel, sampler):
+                    running[job.process.pid] = job
+                else:
+                    self._finish(job)
+            finished = 0
+            for job in self._reap(running):
+                self._finish(job)
+                finished += 1
+            if finished:
+                notifier._save_status(jobs=_job_summaries(jobs))
+            if queue and len(running) < self.slots:
+                continue
+            elif running:
+                readable, _, _ = select.select((wakeup_r,), (), (), wheel.next_timeout())
+                if readable:
+                    os.read(wakeup_r, 4096)
+                wheel.advance()
+
+    def _start(self, job: Job, notifier: Notifier, wheel: TimerWheel, sampler: ProcSampler) -> bool:
+        job.started = time.time()
+        job.record._save_status(started=job.started)
+        argv = _argv(job.command)
+        try:
+            if argv is None:
+                raise ValueError(f"cannot parse command `{job.command}`")
+            job.process = subprocess.Popen(argv)
+        except (OSError, ValueError) as e:
+            # record the failure the way a shell would: as a command that exited with status 127
+            sys.stderr.write(f"Error running job {job.index}: {e}\n")
+            job.exitcode = 127
+            return False
+        job.record.pid = job.process.pid
+        job.record._save_status(pid=job.process.pid)
+        job.record.status = Status.MONITORING
+        if notifier.timeout is not None or notifier.stall is not None:
+            def on_alert(alert: Alert, detail: str):
+                notifier._alert(alert, f"has a job that {detail}: job {job.index}, `{job.command}`")
+
+            job.watchdog = Watchdog(on_alert, wheel, sampler, job.started, timeout=notifier.timeout,
+                                    stall=notifier.stall, repeat=notifier.repeat, pid=job.process.pid)
+        return True
+
+    @staticmethod
+    def _reap(running: Dict[int, Job]) -> Iterable[Job]:
+        while running:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            job = running.pop(pid, None)
+            if job is None:
+                continue
+            job.exitcode = _exitcode(status)
+            # let Popen know that we already reaped the process
+            job.process.returncode = job.exitcode
+            # ru_maxrss is not recorded because it includes the peak memory of this process from before the fork
+            job.cpu_usec = int((rusage.ru_utime + rusage.ru_stime) * 1000000)
+            yield job
+
+    @staticmethod
+    def _finish(job: Job):
+        if job.watchdog is not None:
+            job.watchdog.cancel()
+        job.finished = time.time()
+        job.record._save_status(
+            exitcode=job.exitcode,
+            finished=job.finished,
+            cpu_usec=job.cpu_usec
+        )
+        job.record.status = Status.NOTIFIED
+
+
+def _job_summaries(jobs: List[Job]) -> List[Dict[str, Any]]:
+    return [
+        {
+            'command': job.command,
+            'exitcode': job.exitcode,
+            'started': job.started,
+            'finished': job.finished
+        } for job in jobs
+    ]
+
+
+def _argv(command: str) -> Optional[List[str]]:
+    try:
+        return shlex.split(command) or None
+    except ValueError:
+        return None
+
+
+def _job_name(command: str) -> str:
+    argv = _argv(command)
+    if argv is None:
+        return command
+    return os.path.basename(argv[0])
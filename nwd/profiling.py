@@ -0,0 +1,109 @@
+import atexit
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+from typing import Dict, Optional, TextIO, Tuple
+
+from .notify import PID_DIR
+from .tabular import draw_table
+
+PROFILE_ENV = 'NWD_PROFILE'
+DEFAULT_PROFILE_DIR = os.path.join(PID_DIR, 'profiles')
+
+_profiler: Optional[cProfile.Profile] = None
+_profile_dir: Optional[str] = None
+
+
+def profile_dir_from_env() -> Optional[str]:
+    # NWD_PROFILE is either a directory in which to save profiles, or a flag like "1" to use the default directory
+    value = os.environ.get(PROFILE_ENV, '').strip()
+    if not value or value.lower() in ('0', 'false', 'no', 'off'):
+        return None
+    elif value.lower() in ('1', 'true', 'yes', 'on'):
+        return DEFAULT_PROFILE_DIR
+    return value
+
+
+def enable(profile_dir: str):
+    # Profiles this process, and every process it forks, saving a cProfile and a tracemalloc snapshot for each one to
+    # `profile_dir` when it exits
+    global _profiler, _profile_dir
+    if _profiler is not None:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = profile_dir
+    # make the monitor daemons we fork inherit the setting, too
+    os.environ[PROFILE_ENV] = profile_dir
+    tracemalloc.start()
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    atexit.register(_save)
+    if hasattr(os, 'register_at_fork'):
+        # otherwise (before Python 3.7) each child's profile also includes its parent's samples from before the fork
+        os.register_at_fork(after_in_child=_restart)
+
+
+def _restart():
+    global _profiler
+    _profiler.disable()
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    tracemalloc.clear_traces()
+
+
+def _save():
+    if _profiler is None:
+        return
+    _profiler.disable()
+    prefix = os.path.join(_profile_dir, f"nwd-{int(time.time())}-{os.getpid()}")
+    try:
+        _profiler.dump_stats(f"{prefix}.prof")
+        if tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(f"{prefix}.tracemalloc")
+    except OSError as e:
+        sys.stderr.write(f"Error saving the NWD profile to {prefix}: {e}\n")
+
+
+def summarize(profile_dir: str, limit: int = 20, out_stream: Optional[TextIO] = None):
+    # aggregates every profile and allocation snapshot saved in `profile_dir`
+    if out_stream is None:
+        out_stream = sys.stdout
+    profiles = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    snapshots = sorted(glob.glob(os.path.join(profile_dir, '*.tracemalloc')))
+    if not profiles and not snapshots:
+        sys.stderr.write(f"There are no NWD profiles in {profile_dir}\n")
+        return
+
+    if profiles:
+        out_stream.write(f"CPU time across {len(profiles)} processes:\n")
+        stats = pstats.Stats(profiles[0], stream=out_stream)
+        for path in profiles[1:]:
+            stats.add(path)
+        # otherwise print_stats() starts with a line for every profile
+        stats.files = []
+        stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+
+    if snapshots:
+        allocations: Dict[str, Tuple[int, int]] = {}
+        for path in snapshots:
+            snapshot = tracemalloc.Snapshot.load(path).filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            for stat in snapshot.statistics('lineno'):
+                location = str(stat.traceback)
+                size, count = allocations.get(location, (0, 0))
+                allocations[location] = (size + stat.size, count + stat.count)
+        out_stream.write(f"Memory still allocated at exit across {len(snapshots)} processes:\n\n")
+        out_stream.flush()
+        top = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        draw_table(
+            ('KiB', 'Blocks', 'Location'),
+            tuple((f"{size / 1024.0:.1f}", str(count), location) for location, (size, count) in top),
+            out_stream=out_stream
+        )
@@ -0,0 +1,275 @@
+from fnmatch import fnmatchcase
+import fcntl
+import json
+import operator
+import os
+import re
+import sys
+import time
+
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from .notify import Notifier, PID_DIR
+from .watchdog import parse_duration
+
+RULES_PATH = os.path.join(PID_DIR, 'rules.json')
+DEDUPE_PATH = os.path.join(PID_DIR, 'dedupe.json')
+CHANNELS = ('desktop', 'email', 'term', 'run')
+
+COMPARISON_PATTERN = re.compile(r'^\s*(==|!=|<=|>=|<|>)?\s*(.+?)\s*$')
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+BYTE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1000, 'kib': 1024, 'm': 1024 ** 2, 'mb': 1000 ** 2, 'mib': 1024 ** 2,
+              'g': 1024 ** 3, 'gb': 1000 ** 3, 'gib': 1024 ** 3, 't': 1024 ** 4, 'tb': 1000 ** 4, 'tib': 1024 ** 4}
+BYTES_PATTERN = re.compile(r'^(\d+(?:\.\d*)?)\s*([a-z]*)$')
+
+Predicate = Callable[[Dict[str, Any]], bool]
+
+
+class RuleError(Exception):
+    pass
+
+
+def parse_bytes(value: str) -> float:
+    m = BYTES_PATTERN.match(value.strip().lower())
+    if not m or m.group(2) not in BYTE_UNITS:
+        raise ValueError(f"Invalid memory size \"{value}\"; expected something like 512MiB or 2G")
+    return float(m.group(1)) * BYTE_UNITS[m.group(2)]
+
+
+def _compile_comparison(field: str, condition: Any, parse: Callable[[str], float]) -> Predicate:
+    if isinstance(condition, bool) or not isinstance(condition, (int, float, str)):
+        raise RuleError(f"Invalid condition for \"{field}\": {condition!r}")
+    if isinstance(condition, str):
+        m = COMPARISON_PATTERN.match(condition)
+        if not m:
+            raise RuleError(f"Invalid condition for \"{field}\": {condition!r}")
+        op = COMPARISONS[m.group(1) or '==']
+        try:
+            threshold = parse(m.group(2))
+        except ValueError as e:
+            raise RuleError(f"Invalid condition for \"{field}\": {e}")
+    else:
+        op = operator.eq
+        threshold = condition
+
+    def predicate(context: Dict[str, Any]) -> bool:
+        value = context[field]
+        return value is not None and op(value, threshold)
+
+    return predicate
+
+
+def _compile_pattern(field: str, condition: Any) -> Predicate:
+    if isinstance(condition, str):
+        patterns: Tuple[str, ...] = (condition,)
+    elif isinstance(condition, list) and all(isinstance(c, str) for c in condition):
+        patterns = tuple(condition)
+    else:
+        raise RuleError(f"Invalid condition for \"{field}\": {condition!r}")
+
+    def predicate(context: Dict[str, Any]) -> bool:
+        value = context[field]
+        return value is not None and any(fnmatchcase(value, pattern) for pattern in patterns)
+
+    return predicate
+
+
+CONDITIONS: Dict[str, Callable[[str, Any], Predicate]] = {
+    'exitcode': lambda field, condition: _compile_comparison(field, condition, int),
+    'runtime': lambda field, condition: _compile_comparison(field, condition, parse_duration),
+    'cpu': lambda field, condition: _compile_comparison(field, condition, parse_duration),
+    'memory': lambda field, condition: _compile_comparison(field, condition, parse_bytes),
+    'name': _compile_pattern,
+    'command': _compile_pattern,
+    'event': _compile_pattern
+}
+# a context with every field that rules can use, against which dedupe keys are checked when the rules are loaded
+SAMPLE_CONTEXT = {'pid': 1, 'name': 'name', 'command': 'command', 'exitcode': 0, 'runtime': 1.0, 'cpu': 1.0,
+                  'memory': 1, 'cgroup': 'cgroup', 'event': 'finished'}
+
+
+class Rule:
+    def __init__(self, index: int, spec: Dict[str, Any]):
+        self.index = index
+        unknown = set(spec.keys()) - {'match', 'notify', 'dedupe'}
+        if unknown:
+            raise RuleError(f"Rule {index}: unknown key(s) {', '.join(sorted(unknown))}")
+        self.predicates: List[Predicate] = self._parse_match(spec.get('match', {}))
+        self.channels: Optional[FrozenSet[str]] = self._parse_notify(spec.get('notify', None))
+        self.dedupe_key: Optional[str] = None
+        dedupe = spec.get('dedupe', None)
+        if dedupe is not None:
+            self._parse_dedupe(dedupe)
+
+    def _parse_match(self, match: Any) -> List[Predicate]:
+        if not isinstance(match, dict):
+            raise RuleError(f"Rule {self.index}: \"match\" must be an object")
+        predicates = []
+        for field, condition in match.items():
+            if field not in CONDITIONS:
+                raise RuleError(f"Rule {self.index}: cannot match on \"{field}\"; expected one of "
+                                f"{', '.join(CONDITIONS.keys())}")
+            try:
+                predicates.append(CONDITIONS[field](field, condition))
+            except RuleError as e:
+                raise RuleError(f"Rule {self.index}: {e}")
+        return predicates
+
+    def _parse_notify(self, notify: Any) -> Optional[FrozenSet[str]]:
+        if notify is None:
+            return None
+        elif isinstance(notify, str):
+            notify = [notify]
+        if not isinstance(notify, list) or any(channel not in CHANNELS for channel in notify):
+            raise RuleError(f"Rule {self.index}: \"notify\" must be a list of channels from {', '.join(CHANNELS)}")
+        return frozenset(notify)
+
+    def _parse_dedupe(self, dedupe: Any):
+        if not isinstance(dedupe, dict) or 'window' not in dedupe:
+            raise RuleError(f"Rule {self.index}: \"dedupe\" must be an object with at least a \"window\"")
+        self.dedupe_key = str(dedupe.get('key', '{command}'))
+        try:
+            self.dedupe_key.format_map(SAMPLE_CONTEXT)
+        except Exception as e:
+            raise RuleError(f"Rule {self.index}: invalid dedupe \"key\" {self.dedupe_key!r}: {e!r}")
+        try:
+            self.dedupe_window = parse_duration(str(dedupe['window']))
+        except ValueError as e:
+            raise RuleError(f"Rule {self.index}: {e}")
+        self.dedupe_limit = dedupe.get('limit', 1)
+        if not isinstance(self.dedupe_limit, int) or self.dedupe_limit < 1:
+            raise RuleError(f"Rule {self.index}: the dedupe \"limit\" must be a positive integer")
+
+    def matches(self, context: Dict[str, Any]) -> bool:
+        return all(predicate(context) for predicate in self.predicates)
+
+
+class RuleSet:
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules: Tuple[Rule, ...] = tuple(rules)
+
+    @property
+    def channels(self) -> FrozenSet[str]:
+        # every channel that any rule might route to
+        return frozenset(channel for rule in self.rules if rule.channels is not None for channel in rule.channels)
+
+    def route(self, context: Dict[str, Any], default: FrozenSet[str]) -> FrozenSet[str]:
+        # returns the channels that should be notified; the first matching rule wins
+        for rule in self.rules:
+            if rule.matches(context):
+                channels = default if rule.channels is None else rule.channels
+                if channels and rule.dedupe_key is not None and not _admit(rule, context):
+                    return frozenset()
+                return channels
+        return default
+
+
+def load_rules(path: str) -> RuleSet:
+    with open(path) as f:
+        try:
+            spec = json.load(f)
+        except ValueError as e:
+            raise RuleError(f"{path} is not valid JSON: {e}")
+    if isinstance(spec, dict):
+        spec = spec.get('rules', [])
+    if not isinstance(spec, list) or not all(isinstance(rule, dict) for rule in spec):
+        raise RuleError(f"{path} must contain a list of rules")
+    return RuleSet(Rule(index, rule) for index, rule in enumerate(spec, start=1))
+
+
+def _admit(rule: Rule, context: Dict[str, Any]) -> bool:
+    # sliding-window rate limit shared by every NWD daemon through a locked file
+    try:
+        key = f"{rule.index}:{rule.dedupe_key.format_map(context)}"
+    except (KeyError, ValueError, IndexError, AttributeError, TypeError):
+        # e.g., a format spec that does not apply to a field that is missing for this event
+        key = f"{rule.index}:{rule.dedupe_key}"
+    now = time.time()
+    with open(DEDUPE_PATH, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            history: Dict[str, Dict[str, Any]] = json.load(f)
+        except ValueError:
+            history = {}
+        # each key records its own window, so that keys from other rules (or from rules that no longer exist) can be
+        # pruned, too
+        pruned = {}
+        for k, entry in history.items():
+            if not isinstance(entry, dict):
+                continue
+            times = [t for t in entry.get('times', ()) if now - t < entry.get('window', 0)]
+            if times:
+                pruned[k] = {'window': entry['window'], 'times': times}
+        recent = pruned.get(key, {}).get('times', [])
+        admitted = len(recent) < rule.dedupe_limit
+        if admitted:
+            pruned[key] = {'window': rule.dedupe_window, 'times': recent + [now]}
+        f.seek(0)
+        f.truncate()
+        json.dump(pruned, f)
+    return admitted
+
+
+def rule_context(notifier: Notifier) -> Dict[str, Any]:
+    status = notifier._raw_status()
+    started = status.get('started')
+    finished = status.get('finished')
+    if started is None:
+        runtime = None
+    elif finished is None or notifier.alert is not None:
+        runtime = time.time() - started
+    else:
+        runtime = finished - started
+    return {
+        'pid': status.get('pid'),
+        'name': status.get('name'),
+        # processes that NWD did not start, and cgroups, are identified by their command line or name
+        'command': status.get('command') or ' '.join(status.get('commandline') or ()) or status.get('name'),
+        'exitcode': status.get('exitcode'),
+        'runtime': runtime,
+        'cpu': None if status.get('cpu_usec') is None else status['cpu_usec'] / 1000000.0,
+        'memory': status.get('memory_peak'),
+        'cgroup': status.get('cgroup'),
+        'event': 'finished' if notifier.alert is None else notifier.alert.name.lower()
+    }
+
+
+class RoutingNotifier(Notifier):
+    # Dispatches each notification to the channels chosen by a RuleSet
+    def __init__(
+            self,
+            rules: RuleSet,
+            channels: Dict[str, Notifier],
+            default: Sequence[str],
+            *args,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.rules = rules
+        self.channels = channels
+        self.default = frozenset(default)
+
+    def deliveries(self) -> List[Notifier]:
+        deliveries = []
+        routed = self.rules.route(rule_context(self), self.default)
+        if self.alert is None:
+            # captured output logs are otherwise only deleted once they have been e-mailed
+            for name, channel in self.channels.items():
+                if name not in routed and hasattr(channel, '_delete_logs'):
+                    channel._delete_logs()
+        for name in sorted(routed):
+            channel = self.channels.get(name)
+            if channel is None:
+                sys.stderr.write(f"Warning: a rule routes to the \"{name}\" channel, which is not configured\n")
+                continue
+            channel.daemon_pid = self.daemon_pid
+            deliveries.append(channel)
+        return deliveries
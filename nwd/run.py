@@ -0,0 +1,24 @@
+import os
+
+from typing import Any, Dict, Optional
+
+from .notify import Notifier
+
+
+class RunNotifier(Notifier):
+    channel = 'run'
+
+    def __init__(self, run_command, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.run_command = run_command
+
+    def spec(self) -> Dict[str, Any]:
+        return {'run_command': self.run_command}
+
+    @classmethod
+    def from_spec(cls, pid: Optional[int], spec: Dict[str, Any]) -> 'RunNotifier':
+        return cls(spec['run_command'], pid)
+
+    def notify(self):
+        os.environ['NWD_EVENT'] = 'finished' if self.alert is None else self.alert.name.lower()
+        os.system(self.run_command)
@@ -1,12 +1,18 @@
 import sys
-import time
 
 from .notify import Notifier
 
 
 class TerminalNotifier(Notifier):
+    channel = 'term'
+
     def notify(self):
-        sys.stdout.write(f"\a\n\nNWD: Process {self.pid} finished at {time.ctime(self.end_time)}")
-        if self.exitcode is not None:
-            sys.stdout.write(f" with exit code {self.exitcode}")
+        sys.stdout.write(f"\a\n\nNWD: {self.summary()}")
+        resources = self.resources
+        if resources is not None:
+            sys.stdout.write(f" after using {resources}")
+        job_report = self.job_report()
+        if job_report:
+            sys.stdout.write(f"\n\n{job_report}")
         sys.stdout.write('\n\n')
+        sys.stdout.flush()
@@ -0,0 +1,336 @@
+from enum import Enum
+import math
+import os
+import re
+import time
+
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import psutil
+
+from .cgroup import read_keyed_file
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d*)?)([smhd])')
+# Linux kernels built with CONFIG_PROC_CHILDREN list the children of each thread, which lets a process tree be walked
+# without scanning the whole process table
+PROC_CHILDREN = os.path.exists(f"/proc/{os.getpid()}/task/{os.getpid()}/children")
+
+
+class Alert(Enum):
+    TIMEOUT = 'is still running'
+    STALL = 'appears to have stalled'
+
+
+def parse_duration(duration: str) -> float:
+    duration = duration.strip().lower()
+    try:
+        seconds = float(duration)
+    except ValueError:
+        parts = DURATION_PATTERN.findall(duration)
+        if not parts or ''.join(value + unit for value, unit in parts) != duration.replace(' ', ''):
+            raise ValueError(f"Invalid duration \"{duration}\"; expected something like 90, 45s, 10m, or 1h30m")
+        seconds = sum(float(value) * DURATION_UNITS[unit] for value, unit in parts)
+    if seconds <= 0:
+        raise ValueError(f"Duration \"{duration}\" must be positive")
+    return seconds
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    parts = []
+    for unit in ('d', 'h', 'm'):
+        quantity, seconds = divmod(seconds, DURATION_UNITS[unit])
+        if quantity or parts:
+            parts.append(f"{quantity}{unit}")
+    if seconds or not parts:
+        parts.append(f"{seconds}s")
+    return ''.join(parts)
+
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'bucket')
+
+    def __init__(self, expires: int, callback: Callable[[], None]):
+        self.expires = expires
+        self.callback = callback
+        self.bucket: Optional[List['Timer']] = None
+
+
+class TimerWheel:
+    # A hierarchical timing wheel: each level has `slots` buckets, and each bucket at level L spans slots**L ticks.
+    # Timers are cascaded down a level as their expiry approaches, so scheduling, cancelling, and expiring are all
+    # constant time regardless of how many timers are pending.
+    def __init__(self, resolution: float = 1.0, slots: int = 64, levels: int = 4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.tick = self._now()
+        self.wheels: List[List[List[Timer]]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.pending = 0
+
+    def _to_ticks(self, when: float) -> int:
+        return int(math.ceil(when / self.resolution))
+
+    def _now(self) -> int:
+        return int(math.floor(time.monotonic() / self.resolution))
+
+    def _insert(self, timer: Timer):
+        ticks = timer.expires - self.tick
+        for level in range(self.levels):
+            if ticks < self.slots ** (level + 1) or level == self.levels - 1:
+                bucket = self.wheels[level][(timer.expires // self.slots ** level) % self.slots]
+                break
+        timer.bucket = bucket
+        bucket.append(timer)
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> Timer:
+        timer = Timer(max(self._to_ticks(time.monotonic() + delay), self.tick + 1), callback)
+        self._insert(timer)
+        self.pending += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        if timer.bucket is not None:
+            timer.bucket.remove(timer)
+            timer.bucket = None
+            self.pending -= 1
+
+    def _idle_ticks(self) -> Optional[int]:
+        # the number of upcoming ticks during which no timer can either expire or cascade
+        if not self.pending:
+            return None
+        nearest = None
+        for level, wheel in enumerate(self.wheels):
+            span = self.slots ** level
+            for offset in range(1, self.slots + 1):
+                tick = (self.tick // span + offset) * span
+                if wheel[(tick // span) % self.slots]:
+                    if nearest is None or tick - self.tick < nearest:
+                        nearest = tick - self.tick
+                    break
+        return nearest - 1
+
+    def next_timeout(self) -> Optional[float]:
+        # the number of seconds until the next timer might expire, or None if there are no timers
+        idle_ticks = self._idle_ticks()
+        if idle_ticks is None:
+            return None
+        return max((self.tick + idle_ticks + 1) * self.resolution - time.monotonic(), 0.0)
+
+    def _step(self):
+        self.tick += 1
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if self.tick % span == 0:
+                bucket_index = (self.tick // span) % self.slots
+                bucket, self.wheels[level][bucket_index] = self.wheels[level][bucket_index], []
+                for timer in bucket:
+                    self._insert(timer)
+        bucket_index = self.tick % self.slots
+        bucket, self.wheels[0][bucket_index] = self.wheels[0][bucket_index], []
+        for timer in bucket:
+            if timer.expires > self.tick:
+                # this timer was scheduled beyond the range of the wheel, so it has wrapped around
+                self._insert(timer)
+                continue
+            timer.bucket = None
+            self.pending -= 1
+            timer.callback()
+
+    def advance(self):
+        # fires every timer that has expired since the last call
+        now = self._now()
+        while self.tick < now:
+            idle_ticks = self._idle_ticks()
+            if idle_ticks is None:
+                self.tick = now
+                break
+            self.tick += min(idle_ticks, now - self.tick - 1)
+            self._step()
+
+
+class ProcSampler:
+    # Periodically samples the CPU time and I/O counters of many process trees and cgroups in one batch, reporting
+    # for each whether it made any progress since the previous sample.
+    def __init__(self, wheel: TimerWheel):
+        self.wheel = wheel
+        self.interval: Optional[float] = None
+        self.targets: Dict[Hashable, Tuple[Optional[int], Optional[str], Callable[[bool], None]]] = {}
+        self.previous: Dict[Hashable, Optional[Tuple[float, int]]] = {}
+        self._timer: Optional[Timer] = None
+
+    def add(self, key: Hashable, on_sample: Callable[[bool], None], interval: float, pid: Optional[int] = None,
+            cgroup: Optional[str] = None):
+        self.targets[key] = (pid, cgroup, on_sample)
+        if self.interval is None or interval < self.interval:
+            self.interval = interval
+            if self._timer is not None:
+                self.wheel.cancel(self._timer)
+            self._timer = self.wheel.schedule(self.interval, self._tick)
+
+    def remove(self, key: Hashable):
+        self.targets.pop(key, None)
+        self.previous.pop(key, None)
+        if not self.targets and self._timer is not None:
+            self.wheel.cancel(self._timer)
+            self._timer = None
+            self.interval = None
+
+    @staticmethod
+    def _sample_cgroup(cgroup: str) -> Tuple[float, int]:
+        cpu = 0.0
+        io = 0
+        try:
+            cpu = read_keyed_file(os.path.join(cgroup, 'cpu.stat')).get('usage_usec', 0) / 1000000.0
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(cgroup, 'io.stat')) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        _, _, value = field.partition('=')
+                        if value.isdigit():
+                            io += int(value)
+        except OSError:
+            pass
+        return cpu, io
+
+    @staticmethod
+    def _sample_process(process: psutil.Process) -> Optional[Tuple[float, int]]:
+        # returns None if we are not permitted to read the process's counters (e.g., it belongs to another user)
+        try:
+            with process.oneshot():
+                cpu_times = process.cpu_times()
+                cpu = cpu_times.user + cpu_times.system
+                try:
+                    io = sum(process.io_counters())
+                except (AttributeError, psutil.AccessDenied):
+                    # I/O counters are not available on every platform
+                    io = 0
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            return 0.0, 0
+        except psutil.AccessDenied:
+            return None
+        return cpu, io
+
+    @staticmethod
+    def _proc_children(pid: int) -> List[psutil.Process]:
+        children = []
+        try:
+            tids = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            return children
+        for tid in tids:
+            try:
+                with open(f"/proc/{pid}/task/{tid}/children") as f:
+                    child_pids = f.read().split()
+            except OSError:
+                # the thread exited
+                continue
+            for child_pid in child_pids:
+                try:
+                    children.append(psutil.Process(int(child_pid)))
+                except psutil.NoSuchProcess:
+                    pass
+        return children
+
+    def sample(self) -> Dict[Hashable, Optional[Tuple[float, int]]]:
+        children: Optional[Dict[int, List[psutil.Process]]] = None
+        if not PROC_CHILDREN and any(pid is not None for pid, _, _ in self.targets.values()):
+            # a single pass over the process table serves every monitored process tree
+            children = {}
+            for process in psutil.process_iter(['ppid']):
+                children.setdefault(process.info['ppid'], []).append(process)
+        samples = {}
+        for key, (pid, cgroup, _) in self.targets.items():
+            if cgroup is not None:
+                samples[key] = self._sample_cgroup(cgroup)
+                continue
+            cpu = 0.0
+            io = 0
+            try:
+                tree = [psutil.Process(pid)]
+            except psutil.NoSuchProcess:
+                tree = []
+            readable = True
+            while tree:
+                process = tree.pop()
+                process_sample = self._sample_process(process)
+                if process_sample is None:
+                    readable = False
+                    break
+                cpu += process_sample[0]
+                io += process_sample[1]
+                if children is None:
+                    tree.extend(self._proc_children(process.pid))
+                else:
+                    tree.extend(children.get(process.pid, ()))
+            samples[key] = (cpu, io) if readable else None
+        return samples
+
+    def _tick(self):
+        self._timer = self.wheel.schedule(self.interval, self._tick)
+        for key, sample in self.sample().items():
+            # a process tree whose counters we cannot read is never considered stalled
+            progressed = sample is None or self.previous.get(key) != sample
+            self.previous[key] = sample
+            self.targets[key][2](progressed)
+
+
+class Watchdog:
+    # Alerts when a monitored process runs longer than `timeout` seconds, or when it makes no progress for `stall`
+    # seconds, optionally repeating the alert every `repeat` seconds for as long as the condition persists.
+    def __init__(
+            self,
+            on_alert: Callable[[Alert, str], None],
+            wheel: TimerWheel,
+            sampler: ProcSampler,
+            started: float,
+            timeout: Optional[float] = None,
+            stall: Optional[float] = None,
+            repeat: Optional[float] = None,
+            pid: Optional[int] = None,
+            cgroup: Optional[str] = None
+    ):
+        self.on_alert = on_alert
+        self.wheel = wheel
+        self.sampler = sampler
+        self.started = started
+        self.timeout = timeout
+        self.stall = stall
+        self.repeat = repeat
+        self.last_progress = time.monotonic()
+        self.last_stall_alert: Optional[float] = None
+        self._timeout_timer: Optional[Timer] = None
+        if timeout is not None:
+            self._timeout_timer = wheel.schedule(max(started + timeout - time.time(), 0.0), self._timed_out)
+        if stall is not None:
+            sampler.add(self, self._sampled, min(max(stall / 4.0, 1.0), 60.0), pid=pid, cgroup=cgroup)
+
+    def _timed_out(self):
+        self._timeout_timer = None
+        self.on_alert(Alert.TIMEOUT, f"has been running for {format_duration(time.time() - self.started)}, "
+                                     f"longer than its {format_duration(self.timeout)} limit")
+        if self.repeat is not None:
+            self._timeout_timer = self.wheel.schedule(self.repeat, self._timed_out)
+
+    def _sampled(self, progressed: bool):
+        now = time.monotonic()
+        if progressed:
+            self.last_progress = now
+            self.last_stall_alert = None
+            return
+        elif now - self.last_progress < self.stall:
+            return
+        elif self.last_stall_alert is not None and (self.repeat is None or now - self.last_stall_alert < self.repeat):
+            return
+        self.last_stall_alert = now
+        self.on_alert(Alert.STALL, f"has not used any CPU time or performed any I/O for "
+                                   f"{format_duration(now - self.last_progress)}")
+
+    def cancel(self):
+        if self._timeout_timer is not None:
+            self.wheel.cancel(self._timeout_timer)
+            self._timeout_timer = None
+        self.sampler.remove(self)